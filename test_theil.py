@@ -1,24 +1,49 @@
-import pandas as pd
-import numpy as np
-import treeTheil as tT
-import matplotlib.pyplot as plt
+import os
+# Must run before numpy is imported, so that the worker processes do
+# not each start a full set of BLAS threads.
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+import pandas as pd  # noqa: E402
+import numpy as np  # noqa: E402
+from joblib import Parallel, delayed  # noqa: E402
+import treeTheil as tT  # noqa: E402
+import matplotlib.pyplot as plt  # noqa: E402
 
-bar = pd.DataFrame(pd.read_csv('test_data_multiyear.csv'))
-levels = ['year', 'city', 'firm']
+
+def compute_all_stats(year, sub, levels, groups, cities, firms):
+    root = str(year)
+    tree = tT.theilTree(sub, root, levels, groups)
+    table, xwins = tT.theil_stats(tree, 1)
+    root_idx = tree.id2idx[root]
+    wins = np.empty(len(cities))
+    for i, city in enumerate(cities):
+        city_idx = tree.id2idx['%s|%s' % (root, city)]
+        wins[i] = tT.win_theil_cmp(tree, city_idx, 1)
+    firmxs = np.empty(len(firms))
+    for i, firm in enumerate(firms):
+        firmxs[i] = xwins.get(firm, 0)
+    return table[root_idx, 1], table[root_idx, 0], wins, firmxs
+
+
+levels = ['city', 'firm']
 groups = ['white', 'black']
-ytargs = "bar[bar['year'] == year], %s, %s" % (levels, groups)
-years = np.array([year for year in bar.year.unique()])
-theils = np.array([tT.theil(tT.theilTree(ytargs), str(year), 1)
-                   for year in bar.year.unique()])
-btws = np.array([tT.btw_theil(tT.theilTree(ytargs), str(year))
-                 for year in bar.year.unique()])
-wins = np.array([[tT.win_theil(tT.theilTree(ytargs), '%s|%s' %
-                               (year, city), 1)
-                  for year in bar.year.unique()]
-                 for city in bar.city.unique()])
-firmxs = np.array([[tT.xwin_theil(tT.theilTree(ytargs), firm)
-                    for year in bar.year.unique()]
-                   for firm in bar.firm.unique()])
+bar = pd.read_csv('test_data_multiyear.csv',
+                  usecols=['year'] + levels + groups,
+                  dtype={'year': 'int32', 'city': 'category',
+                         'firm': 'category', 'white': 'float32',
+                         'black': 'float32'})
+cities = bar.city.unique()
+firms = bar.firm.unique()
+per_year = list(bar.groupby('year', sort=False))
+results = Parallel(n_jobs=-1, backend='loky')(
+    delayed(compute_all_stats)(year, sub, levels, groups, cities, firms)
+    for year, sub in per_year)
+years = np.array([year for year, sub in per_year])
+theils = np.empty(len(years))
+btws = np.empty(len(years))
+wins = np.empty((len(cities), len(years)))
+firmxs = np.empty((len(firms), len(years)))
+for j, result in enumerate(results):
+    theils[j], btws[j], wins[:, j], firmxs[:, j] = result
 
 plt.plot(years, theils)
 plt.show()
@@ -1,6 +1,15 @@
-from math import log
-from copy import deepcopy
-from treelib import Tree
+import numpy as np
+import pandas as pd
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(**options):
+        '''Stand-in for numba.njit when numba is not installed. The
+        kernels are written to run unchanged as plain Python.
+
+        '''
+        return lambda func: func
 
 ########################################################################
 # Functions and class for building a Theil tree
@@ -28,28 +37,45 @@ from treelib import Tree
 #    `-LeafA (G1, G2)
 #
 # ...etc. The Theil statistics can then be calculated recursively
-# across the nodes in this tree. The "Thile" class is the data
-# structure that is appended to the nodes.  It holds the group numbers
-# for that node and can be queried for its total size, its lowest
-# identifying unit, and the entropy between the groups.
-
-
-class Thile(object):
-
-    def __init__(self, groups, lunit):
-        self.groups = groups
-        self.lunit = lunit
-
-    def total(self):
-        total = sum(self.groups.values())
-        return total
-
-    def entropy(self):
-        entropy = sum((0 if foo == 0 else (float(foo) / self.total() *
-                                           log(self.total() /
-                                               float(foo), 2))) for foo in
-                      self.groups.values())
-        return entropy
+# across the nodes in this tree. The "TheilTree" class holds the tree
+# as a structure of arrays: every node gets an integer index, and its
+# parent, children, level, lowest identifying unit, and group numbers
+# are looked up by that index.  The group numbers sit in a single
+# (nodes x groups) array, so the tree can be queried for any node's
+# total size and the entropy between its groups.
+
+
+class TheilTree(object):
+
+    def __init__(self, group_names=()):
+        self.group_names = list(group_names)
+        self.ids = []
+        self.id2idx = {}
+        self.lunit = []
+        self.path_parts = []
+        self.lunit_index = {}
+        self.lunit_code = np.empty(0, dtype=np.int32)
+        self.prior_idx = None
+        self.theil_table = None
+        self.parent = np.empty(0, dtype=np.int32)
+        self.level = np.empty(0, dtype=np.int32)
+        self.children = []
+        self.children_ptr = np.zeros(1, dtype=np.int64)
+        self.children_flat = np.empty(0, dtype=np.int32)
+        self.groups = np.empty((0, len(self.group_names)))
+        self.total = np.empty(0)
+        self.entropy = np.empty(0)
+        self.weight = np.empty(0)
+        self.diversity = np.empty(0)
+        self.entdev = np.empty(0)
+        self.weight_recur = np.empty(0)
+        self.diversity_recur = np.empty(0)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, nid):
+        return nid in self.id2idx
 
 
 def maybefloat(value):
@@ -63,67 +89,160 @@ def maybefloat(value):
         return value
 
 
-def inc_dict(fromDict, toDict):
-    '''Adds values in a pair of dictionaries.'''
-    for key in toDict.keys():
-        toDict[key] += fromDict[key]
+def tree_structure(tree, dataframe, root, levels, groups):
+    '''Creates the tree from the columns of the dataframe. Node IDs
+    for every row are built one level at a time, and each level's
+    nodes are indexed in order of first appearance, so parents always
+    come before their children. Every row also carries the index of
+    its node at the current level, which gives each new node's parent
+    without looking up the parent's ID. Only the first row for a given
+    leaf supplies its data.
 
+    Node IDs concatenate values for the different levels (joined by
+    pipe characters), starting from the root; each node's path_parts
+    keeps the same values as a tuple. Nodes are also indexed by their
+    lunit, so nodes sharing one can be found without a scan, and each
+    node's lunit_code numbers its lunit in the order of that index.
 
-def deepcopy_node_data(tree, fromNode, toNode):
-    '''Copies data structure across nodes. Need to use deepcopy rather
-    than copy, because otherwise the pointer will be to the original
-    data.
+    The data can be a dataframe or any iterable of row dictionaries,
+    such as a csv.DictReader.
 
     '''
-    tree[toNode].data.groups = deepcopy(tree[fromNode].data.groups)
+    if not isinstance(dataframe, pd.DataFrame):
+        dataframe = pd.DataFrame(list(dataframe))
+    lvl_arrs = [dataframe[level].to_numpy().astype(str) for level in levels]
+    dat_arr = dataframe[list(groups)].to_numpy(dtype=float)
+    tree.group_names = list(groups)
+    tree.ids = [root]
+    tree.id2idx = {root: 0}
+    tree.lunit = [root]
+    tree.path_parts = [(root,)]
+    tree.lunit_index = {root: [0]}
+    parent = [-1]
+    level = [0]
+    leaf_rows = []
+    nids = np.full(len(dataframe), root)
+    row_idx = np.zeros(len(dataframe), dtype=np.int64)
+    for i, lvl_arr in enumerate(lvl_arrs):
+        nids = np.char.add(np.char.add(nids, '|'), lvl_arr)
+        first, inverse = np.unique(nids, return_index=True,
+                                   return_inverse=True)[1:]
+        order = np.argsort(first)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        first_rows = first[order]
+        parent_idx = row_idx[first_rows].tolist()
+        start = len(tree.ids)
+        row_idx = start + rank[inverse.reshape(-1)]
+        new_ids = nids[first_rows].tolist()
+        new_lunits = lvl_arr[first_rows].tolist()
+        for idx, lunit in enumerate(new_lunits, start):
+            tree.lunit_index.setdefault(lunit, []).append(idx)
+        tree.id2idx.update(zip(new_ids, range(start, start + len(new_ids))))
+        tree.ids.extend(new_ids)
+        tree.lunit.extend(new_lunits)
+        tree.path_parts.extend([tree.path_parts[pidx] + (lunit,)
+                                for pidx, lunit in zip(parent_idx,
+                                                       new_lunits)])
+        parent.extend(parent_idx)
+        level.extend([i + 1] * len(new_ids))
+        if i == len(levels)-1:
+            leaf_rows = first_rows
+    tree.parent = np.array(parent, dtype=np.int32)
+    tree.lunit_code = np.empty(len(tree.ids), dtype=np.int32)
+    for code, idxs in enumerate(tree.lunit_index.values()):
+        tree.lunit_code[idxs] = code
+    tree.level = np.array(level, dtype=np.int32)
+    tree.groups = np.zeros((len(tree.ids), len(groups)))
+    np.take(dat_arr, leaf_rows, axis=0,
+            out=tree.groups[len(tree.ids) - len(leaf_rows):])
+    counts = np.bincount(tree.parent[1:], minlength=len(tree.ids))
+    tree.children_ptr = np.zeros(len(tree.ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=tree.children_ptr[1:])
+    tree.children_flat = (np.argsort(tree.parent[1:], kind='stable') +
+                          1).astype(np.int32)
+    tree.children = np.split(tree.children_flat, tree.children_ptr[1:-1])
+
+
+@njit(cache=True)
+def leaf_up_tree_nb(parent, groups):
+    '''Compiled kernel for leaf_up_tree.'''
+    for idx in range(len(parent) - 1, 0, -1):
+        groups[parent[idx]] += groups[idx]
 
 
-def tree_structure(tree, csvdict, root, levels, groups):
-    '''Single pass through the dataframe to create the tree. Works down
-    from the root, passing already-created nodes, and assigns the data
-    to the leaf node.
-
-    Node IDs concatenate values for the different levels (joined by
-    pipe characters), starting from the root.
+def leaf_up_tree(tree):
+    '''Single bottom-up pass to hierarchically sum data up the tree.
+    Parents are indexed before their children, so going through the
+    indices backwards adds every node to its parent exactly once, after
+    all of its own children have been added to it.
 
     '''
-    tree.create_node(root, root, data=Thile({}, root))
-    for row in csvdict:
-        nid = root
-        leaf_data = {group: float(row[group]) for group in groups}
-        for i in range(len(levels)):
-            pid = nid
-            nid += '|%s' % row[levels[i]]
-            lunit = row[levels[i]]
-            if tree.contains(nid):
-                pass
-            elif i == len(levels)-1:
-                tree.create_node(nid, nid, parent=pid,
-                                 data=Thile(leaf_data, lunit))
-            else:
-                tree.create_node(nid, nid, parent=pid, data=Thile({}, lunit))
+    leaf_up_tree_nb(tree.parent, tree.groups)
 
 
-def leaf_up_tree(tree):
-    '''Single pass through leaves to hierarchically sum data up the
-    tree. The child's data dictionary is deep-copied to the parent if
-    the latter has no data, and added to the parent node's data if it
-    does.
+@njit(cache=True)
+def node_recur_nb(parent, weight, diversity, weight_recur, diversity_recur):
+    '''Compiled kernel for the root-relative weights and diversities in
+    node_stats.
+
+    '''
+    for idx in range(1, len(parent)):
+        weight_recur[idx] = weight_recur[parent[idx]] * weight[idx]
+        diversity_recur[idx] = diversity_recur[parent[idx]] * diversity[idx]
+
+
+def node_stats(tree):
+    '''Computes every node's total size and the entropy between its
+    groups in one vectorized pass over the aggregated tree. The group
+    numbers do not change once they have been summed up the tree, so
+    these are stored as arrays rather than recomputed on every query.
+    Empty groups contribute nothing to a node's entropy, and empty
+    nodes have zero entropy.
+
+    Each node's weight, diversity, and entropy deviation relative to
+    its parent are stored the same way, as zero wherever the parent's
+    total or entropy is zero. The root is its own reference, with a
+    weight and diversity of one and no entropy deviation. Weights and
+    diversities relative to the root are products along the path from
+    the root, so one sweep forward through the indices gives them for
+    every node. Any table kept by theil_stats is dropped, since it was
+    computed from the old numbers.
 
     '''
-    for path in tree.paths_to_leaves():
-        leaf = path.pop()
-        for parent in path:
-            if tree[parent].data.groups == {}:
-                deepcopy_node_data(tree, leaf, parent)
-            else:
-                inc_dict(tree[leaf].data.groups, tree[parent].data.groups)
-
-
-def theilTree(csvdict, root, levels, groups):
-    tree = Tree()
-    tree_structure(tree, csvdict, root, levels, groups)
+    tree.theil_table = None
+    tree.total = tree.groups.sum(axis=1)
+    nonzero = tree.groups > 0
+    shares = np.divide(tree.groups, tree.total[:, None],
+                       out=np.zeros_like(tree.groups), where=nonzero)
+    log_shares = np.log2(shares, out=np.zeros_like(shares), where=nonzero)
+    tree.entropy = 0.0 - np.multiply(shares, log_shares,
+                                     out=log_shares).sum(axis=1)
+    parent_total = tree.total[tree.parent[1:]]
+    parent_entropy = tree.entropy[tree.parent[1:]]
+    safe_total = np.where(parent_total == 0, 1.0, parent_total)
+    safe_entropy = np.where(parent_entropy == 0, 1.0, parent_entropy)
+    tree.weight = np.ones(len(tree))
+    tree.diversity = np.ones(len(tree))
+    tree.entdev = np.zeros(len(tree))
+    tree.weight[1:] = np.where(parent_total == 0, 0.0,
+                               tree.total[1:] / safe_total)
+    tree.diversity[1:] = np.where(parent_entropy == 0, 0.0,
+                                  tree.entropy[1:] / safe_entropy)
+    tree.entdev[1:] = np.where(parent_entropy == 0, 0.0,
+                               (parent_entropy - tree.entropy[1:]) /
+                               safe_entropy)
+    tree.weight_recur = np.ones(len(tree))
+    tree.diversity_recur = np.ones(len(tree))
+    node_recur_nb(tree.parent, tree.weight, tree.diversity,
+                  tree.weight_recur, tree.diversity_recur)
+
+
+def theilTree(dataframe, root, levels, groups):
+    tree = TheilTree(groups)
+    tree_structure(tree, dataframe, root, levels, groups)
     leaf_up_tree(tree)
+    node_stats(tree)
     return tree
 
 
@@ -132,56 +251,51 @@ def theilTree(csvdict, root, levels, groups):
 ########################################################################
 
 
-def node_weight(tree, nid):
+# Nodes are passed to these functions as integer indices into the
+# tree's arrays.  The pipe-joined node IDs are only labels: look an
+# index up with tree.id2idx[nid], and get the label back with
+# tree.ids[idx].
+
+
+def node_weight(tree, idx):
     '''Node's weight as a share of its parent'''
-    return (0 if tree.parent(nid).data.total() == 0 else
-            tree[nid].data.total() / tree.parent(nid).data.total())
+    return tree.weight[idx]
 
 
-def node_diversity(tree, nid):
+def node_diversity(tree, idx):
     '''Node's diversity relative to its parent'''
-    return (0 if tree.parent(nid).data.entropy() == 0 else
-            tree[nid].data.entropy() / tree.parent(nid).data.entropy())
+    return tree.diversity[idx]
 
 
-def node_entdev(tree, nid):
+def node_entdev(tree, idx):
     '''Node's entropy deviation from its parent'''
-    return (0 if tree.parent(nid).data.entropy() == 0 else
-            (tree.parent(nid).data.entropy() - tree[nid].data.entropy()) /
-            tree.parent(nid).data.entropy())
+    return tree.entdev[idx]
 
 
-def node_weight_recur(tree, nid):
+def node_weight_recur(tree, idx):
     '''Weight of a node in the larger tree, versus weight as a share of
-    its parent.  Calculated upward to tree root.
+    its parent.  Calculated upward to tree root when the tree is built.
 
     '''
-    if tree.level(nid) == 0:
-        return 1
-    else:
-        return node_weight(tree, nid) * \
-            node_weight_recur(tree, tree.parent(nid).identifier)
+    return tree.weight_recur[idx]
 
 
-def node_diversity_recur(tree, nid):
+def node_diversity_recur(tree, idx):
     '''Relative diversity of a node in the larger tree, versus diversity
-    relative to its parent.  Calculated upward to tree root.
+    relative to its parent.  Calculated upward to tree root when the
+    tree is built.
 
     '''
-    if tree.level(nid) == 0:
-        return 1
-    else:
-        return node_diversity(tree, nid) * \
-            node_diversity_recur(tree, tree.parent(nid).identifier)
+    return tree.diversity_recur[idx]
 
 
-def theil_cmp(tree, nid):
+def theil_cmp(tree, idx):
     '''Node's contribution to its parent's Theil statistic. Calculated as
     the node's entropy deviation from its parent, weighted by its size
     as a share of the parent.
 
     '''
-    return node_weight(tree, nid) * node_entdev(tree, nid)
+    return tree.weight[idx] * tree.entdev[idx]
 
 
 # Because the data are in a tree structure, one can recur through
@@ -190,40 +304,113 @@ def theil_cmp(tree, nid):
 # cannot be segregated.  Letting the recursion terminate with the
 # additive identity spares a lot of conditional branching to test
 # whether nodes are leaves.
-def theil(tree, nid, recursions):
+#
+# The recursion is run by theil_nb as an explicit stack over the
+# tree's arrays, with children in compressed rows (the children of
+# node i are children_flat[children_ptr[i]:children_ptr[i+1]]), so
+# that numba can compile it.  Each stack entry carries the product of
+# weights and diversities from the queried node down to its parent.
+# As in the recursive version, only a count that reaches exactly zero
+# stops the descent, so a negative count recurses down to the leaves.
+@njit(cache=True)
+def theil_nb(children_flat, children_ptr, weight, entdev, diversity,
+             root_idx, levels):
+    '''Compiled kernel for theil, called on node indices.'''
+    stack_node = np.empty(len(weight), dtype=np.int64)
+    stack_levels = np.empty(len(weight), dtype=np.int64)
+    stack_scale = np.empty(len(weight), dtype=np.float64)
+    stack_node[0] = root_idx
+    stack_levels[0] = levels
+    stack_scale[0] = 1.0
+    top = 1
+    the_theil = 0.0
+    while top > 0:
+        top -= 1
+        pidx = stack_node[top]
+        remaining = stack_levels[top]
+        scale = stack_scale[top]
+        for k in range(children_ptr[pidx], children_ptr[pidx + 1]):
+            idx = children_flat[k]
+            the_theil += scale * weight[idx] * entdev[idx]
+            if remaining != 0:
+                stack_node[top] = idx
+                stack_levels[top] = remaining - 1
+                stack_scale[top] = scale * weight[idx] * diversity[idx]
+                top += 1
+    return the_theil
+
+
+def theil(tree, idx, recursions):
     '''Size-weighted sum of entropy deviations of a parent's children.
+    Read from the tree's table of Theil statistics when theil_stats has
+    already filled one deep enough.
 
     '''
-    the_theil = 0
-    if recursions == 0:
-        for child in tree.children(nid):
-            the_theil += theil_cmp(tree, child.identifier)
-    else:
-        for child in tree.children(nid):
-            the_theil += theil_cmp(tree, child.identifier)
-            the_theil += node_weight(tree, child.identifier) * \
-                node_diversity(tree, child.identifier) * \
-                theil(tree, child.identifier, recursions - 1)
-    return the_theil
+    if (tree.theil_table is not None and
+            0 <= recursions < tree.theil_table.shape[1]):
+        return tree.theil_table[idx, recursions]
+    return theil_nb(tree.children_flat, tree.children_ptr, tree.weight,
+                    tree.entdev, tree.diversity, idx, recursions)
+
+
+# theil_stats_nb fuses the queries into one sweep over the whole tree.
+# Nodes are indexed so that parents come before their children, so
+# going through the indices backwards finishes every node before its
+# parent is reached.  Row idx of the table holds theil(tree, idx, r)
+# for every r up to the number of recursions.
+@njit(cache=True)
+def theil_stats_nb(parent, weight, entdev, diversity, recursions):
+    '''Compiled kernel for theil_stats.'''
+    table = np.zeros((len(parent), recursions + 1))
+    for idx in range(len(parent) - 1, 0, -1):
+        pidx = parent[idx]
+        cmp = weight[idx] * entdev[idx]
+        table[pidx, 0] += cmp
+        for r in range(1, recursions + 1):
+            table[pidx, r] += (cmp + weight[idx] * diversity[idx] *
+                               table[idx, r - 1])
+    return table
+
+
+def theil_stats(tree, recursions):
+    '''Theil statistics for every node of the tree from a single sweep.
+    Returns a table in which row idx, column r is theil(tree, idx, r),
+    so column 0 is btw_theil, and a dictionary of xwin_theil for every
+    lunit in the tree. The table is also kept on the tree, so later
+    theil calls at these depths are lookups. As with theil, a negative
+    number of recursions means no depth limit, which the table covers
+    by going as deep as the tree.
 
-
-def btw_theil(tree, nid):
+    '''
+    if recursions < 0:
+        recursions = int(tree.level.max())
+    table = theil_stats_nb(tree.parent, tree.weight, tree.entdev,
+                           tree.diversity, recursions)
+    tree.theil_table = table
+    xwin_cmps = tree.entdev * tree.weight_recur * tree.diversity_recur
+    xwins = dict(zip(tree.lunit_index,
+                     np.bincount(tree.lunit_code, weights=xwin_cmps,
+                                 minlength=len(tree.lunit_index))))
+    return table, xwins
+
+
+def btw_theil(tree, idx):
     '''Between-child component of a parent's Theil statistic.'''
-    return theil(tree, nid, 0)
+    return theil(tree, idx, 0)
 
 
-def win_theil_cmp(tree, child_nid, recursions):
+def win_theil_cmp(tree, child_idx, recursions):
     '''Within-child component of a parent's Theil statistic.  Called on a
     specific child.  Allows recursion on the within-component Theil.
 
     '''
-    return theil(tree, child_nid, recursions) * \
-        node_weight(tree, child_nid) * node_diversity(tree, child_nid)
+    return theil(tree, child_idx, recursions) * \
+        tree.weight[child_idx] * tree.diversity[child_idx]
 
 
-def win_theils(tree, nid, recursions):
+def win_theils(tree, idx, recursions):
     win_theils = 0
-    for child in tree.children(nid):
+    for child in tree.children[idx]:
         win_theils += win_theil_cmp(tree, child, recursions)
     return win_theils
 
@@ -241,57 +428,99 @@ def xwin_theil(tree, lunit):
     more sense to build the tree differently.
 
     '''
-    xwin_theil = 0
-    for node in tree.filter_nodes(lambda n: n.data.lunit == lunit):
-        xwin_theil += (node_entdev(tree, node.identifier) *
-                       node_weight_recur(tree, node.identifier) *
-                       node_diversity_recur(tree, node.identifier))
-    return xwin_theil
+    idxs = tree.lunit_index.get(lunit, [])
+    return (tree.entdev[idxs] * tree.weight_recur[idxs] *
+            tree.diversity_recur[idxs]).sum()
 
 
-def mtree_stage(mtree, nid):
+def mtree_stage(mtree, idx):
     '''Returns the 1th element of the node ID which, in a multi-tree,
     identifies the tree within the multi-tree.
 
     '''
-    return list(mtree[nid].identifier.split('|'))[1]
+    return mtree.path_parts[idx][1]
 
 
-def mtree_nid(mtree, nid):
+def mtree_nid(mtree, idx):
     '''Returns the 2th and subsequent elements of the node ID. '''
-    return '|'.join(list(mtree[nid].identifier.split('|'))[2:])
+    return '|'.join(mtree.path_parts[idx][2:])
 
 
-def mtree_root(mtree, nid):
+def mtree_root(mtree, idx):
     '''Returns the 0th element of the node ID, i.e., the root.'''
-    return list(mtree[nid].identifier.split('|'))[0]
+    return mtree.path_parts[idx][0]
 
 
-def change_comps(mtree, nid):
+def mtree_prior(mtree):
+    '''Index of each node's counterpart in the previous stage of a
+    multi-tree, or -1 where there is none. A stage's counterpart is the
+    stage numbered one lower; below that, a node's counterpart is the
+    child of its parent's counterpart with the same lunit. Parents are
+    indexed before their children, so one forward pass over integer
+    keys builds the whole map. It is kept on the tree after first use.
+    Stages whose labels are not integers have no counterparts.
+
+    '''
+    if mtree.prior_idx is None:
+        stage_of = {}
+        for idx in mtree.children[0].tolist():
+            try:
+                stage_of[idx] = int(mtree_stage(mtree, idx))
+            except ValueError:
+                pass
+        stages = {stage: idx for idx, stage in stage_of.items()}
+        parent = mtree.parent.tolist()
+        lunit_code = mtree.lunit_code.tolist()
+        child_of = dict(zip(zip(parent, lunit_code), range(len(mtree))))
+        prior_idx = [-1] * len(mtree)
+        for idx, stage in stage_of.items():
+            prior_idx[idx] = stages.get(stage - 1, -1)
+        for idx in range(1, len(mtree)):
+            pidx = parent[idx]
+            if pidx != 0 and prior_idx[pidx] >= 0:
+                prior_idx[idx] = child_of.get(
+                    (prior_idx[pidx], lunit_code[idx]), -1)
+        mtree.prior_idx = np.array(prior_idx, dtype=np.int64)
+    return mtree.prior_idx
+
+
+def change_comps(mtree, idx):
     '''Analyzes changes in a node's Thiel component into segregation and
     population effects.  Defined on a multitree, where each major
-    branch off of root is a year or other relevant stage.
+    branch off of root is a year or other relevant stage.  Also takes
+    an array of nodes, and then returns arrays of components.
 
     In the notation used here, E is node entropy, e is node entropy
     deviation from its parent, w is node size, and p is node weight; j
     indexes child nodes.
 
     '''
-    Ej_new = mtree[nid].data.entropy()
-    E_new = mtree.parent(nid).data.entropy()
-    wj_new = mtree[nid].data.total()
-    w_new = mtree.parent(nid).data.total()
-
-    oldnid = '|'.join([mtree_root(mtree, nid),
-                       str(int(mtree_stage(mtree, nid)) - 1),
-                       mtree_nid(mtree, nid)])
-
-    Ej = mtree[oldnid].data.entropy()
-    E = mtree.parent(oldnid).data.entropy()
-    wj = mtree[oldnid].data.total()
-    w = mtree.parent(oldnid).data.total()
-    pj = node_weight(mtree, oldnid)
-    ej = node_entdev(mtree, oldnid)
+    entropy = mtree.entropy
+    total = mtree.total
+    pidx = mtree.parent[idx]
+    Ej_new = entropy[idx]
+    E_new = entropy[pidx]
+    wj_new = total[idx]
+    w_new = total[pidx]
+
+    for stage in set(mtree_stage(mtree, i)
+                     for i in np.atleast_1d(idx).tolist()):
+        try:
+            int(stage)
+        except ValueError:
+            raise ValueError('multi-tree stage %r is not an integer' %
+                             stage)
+    oldidx = mtree_prior(mtree)[idx]
+    if np.any(oldidx < 0):
+        raise KeyError('no previous stage for node %s' % (idx,))
+    oldpidx = mtree.parent[oldidx]
+
+    Ej = entropy[oldidx]
+    E = entropy[oldpidx]
+    wj = total[oldidx]
+    w = total[oldpidx]
+    pj = mtree.weight[oldidx]
+    ej = mtree.entdev[oldidx]
 
     dotE = E_new - E
     dotEj = Ej_new - Ej
@@ -303,12 +532,14 @@ def change_comps(mtree, nid):
     return seg_comp, pop_comp
 
 
-# This is wrong, because you can't += tuples. Come back to it.
-def theil_changes(tree, nid):
-    theil_changes = 0
-    for child in tree.children(nid):
-        theil_changes += change_comps(tree, child.identifier)
-    return theil_changes
+def theil_changes(tree, idx):
+    '''Segregation and population components of the change in a node's
+    Theil statistic, summed over its children.  Returned as an array of
+    (segregation, population).
+
+    '''
+    seg_comps, pop_comps = change_comps(tree, tree.children[idx])
+    return np.array([seg_comps.sum(), pop_comps.sum()])
 
 
 # def newish_tree(dataframe, root, levels):